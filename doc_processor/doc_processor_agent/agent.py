@@ -12,21 +12,30 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import mimetypes
+import os
+import time
+from typing import AsyncGenerator, List
+
+from google import genai
 from google.adk.agents import LlmAgent,BaseAgent,SequentialAgent
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event, EventActions
+from google.genai import types
 from pydantic import BaseModel, Field
 
 from .pydantic_model import Receipt
 
 # Import the tools
-from .tools import log_expense_to_bigquery
+from .tools import log_expense_to_bigquery, log_expenses_batch
+
+logger = logging.getLogger(__name__)
 
 
 class OcrInput(BaseModel):
     image_path: str = Field(description="The path to the receipt image file.")
 
-class ClassificationOutput(BaseModel):
-    category: str = Field(description="The classified expense category.")
-
 
 
 ocr_extractor_agent = LlmAgent(
@@ -40,6 +49,8 @@ ocr_extractor_agent = LlmAgent(
     - Total Amount
     - A list of all line items, including their description, quantity, and price.
 
+    Leave the category field empty; it is assigned when the expense is logged.
+
     You must return the extracted information in a structured JSON format conforming to the Receipt model.
     For the purpose of this simulation, you will generate realistic mock data based on the image path.
     For example, if the image_path contains 'grocery', generate grocery-related items.
@@ -49,41 +60,183 @@ ocr_extractor_agent = LlmAgent(
     output_key="extracted_receipt"
 )
 
-category_classifier_agent = LlmAgent(
-    name="category_classifier_agent",
-    model="gemini-2.0-flash",
-    description="Classifies the expense category based on receipt data.",
-    instruction="""You are an expense categorization agent.
-    Given the structured data from a receipt (vendor name and line items), determine the most appropriate expense category.
-    The possible categories are: Dining, Groceries, Fuel, Travel, Entertainment, and Other.
-    Analyze the vendor name and the descriptions of the line items to make your classification.
-    Return only the determined category as a string.
-
-    The receipt data will be available in the session state under the key 'extracted_receipt'.
-    """,
-    output_schema=ClassificationOutput,
-    output_key="classified_category"
-)
+class FinanceLoggerAgent(BaseAgent):
+    """
+    Logs the extracted receipt to BigQuery without an LLM call.
+
+    Logging is a fixed tool call with no reasoning involved, so the receipt is
+    read from the session state and passed to `log_expense_to_bigquery`
+    directly. This saves a full model round-trip per receipt.
+    """
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        receipt = ctx.session.state.get("extracted_receipt")
+        if receipt is None:
+            result = {"status": "error", "message": "No extracted receipt found in session state."}
+        else:
+            result = await log_expense_to_bigquery(receipt)
 
-finance_logger_agent = LlmAgent(
+        if result["status"] == "error":
+            message = f"Failed to log expense: {result['message']}"
+        else:
+            message = f"Expense logged with status '{result['status']}' and record ID {result['record_id']}."
+        yield Event(
+            author=self.name,
+            invocation_id=ctx.invocation_id,
+            branch=ctx.branch,
+            content=types.Content(role="model", parts=[types.Part(text=message)]),
+            actions=EventActions(state_delta={"expense_log_result": result}),
+        )
+
+
+finance_logger_agent = FinanceLoggerAgent(
     name="finance_logger_agent",
-    model="gemini-2.0-flash",
     description="Logs the classified expense into a financial system (BigQuery).",
-    instruction="""You are a finance logging agent.
-    Your task is to take the final, categorized expense data and log it into the company's financial system using the 'log_expense_to_bigquery' tool.
-    The receipt data will be in the session state under 'extracted_receipt' and the category under 'classified_category'.
-    You must call the tool with the correct data.
-    After successfully calling the tool, respond with a confirmation message including the status and record ID returned by the tool.
-    """,
-    tools=[log_expense_to_bigquery]
 )
 
 root_agent = SequentialAgent(
     name="expense_tracker_orchestrator",
     sub_agents=[
         ocr_extractor_agent,
-        category_classifier_agent,
         finance_logger_agent
     ],
     description="Orchestrates the entire expense tracking workflow from OCR to logging."
 )
+
+
+BATCH_OCR_MODEL = "gemini-2.0-flash"
+
+BATCH_OCR_PROMPT = """You are an OCR (Optical Character Recognition) agent.
+Extract the following information from the attached receipt image:
+- Vendor Name
+- Transaction Date (YYYY-MM-DD)
+- Total Amount
+- A list of all line items, including their description, quantity, and price.
+
+Return the extracted information as JSON conforming to the Receipt model. Leave the category empty.
+"""
+
+# Inline batch requests are limited to 20 MB in total. Images travel base64
+# encoded alongside the prompt and schema, so jobs are kept below this estimate.
+MAX_INLINE_BATCH_BYTES = 18 * 1024 * 1024
+_INLINE_REQUEST_OVERHEAD_BYTES = 4 * 1024
+
+_BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+}
+
+
+def _inline_request_for(image_path: str) -> dict:
+    """Builds an inline Gemini batch request that runs OCR on one receipt image."""
+    with open(image_path, "rb") as image_file:
+        image_bytes = image_file.read()
+    mime_type = mimetypes.guess_type(image_path)[0] or "image/png"
+    return {
+        "contents": [{
+            "role": "user",
+            "parts": [
+                {"text": BATCH_OCR_PROMPT},
+                {"inline_data": {"mime_type": mime_type, "data": image_bytes}},
+            ],
+        }],
+        "config": {
+            "response_mime_type": "application/json",
+            "response_schema": Receipt,
+        },
+    }
+
+
+def _inline_request_size(image_path: str) -> int:
+    """Estimates the size of the inline request for one image, once base64 encoded."""
+    return -(-os.path.getsize(image_path) // 3) * 4 + _INLINE_REQUEST_OVERHEAD_BYTES
+
+
+def _split_by_request_size(image_paths: List[str], max_bytes: int) -> List[List[str]]:
+    """Groups image paths into consecutive jobs whose inline requests fit in `max_bytes`."""
+    jobs: List[List[str]] = []
+    job: List[str] = []
+    job_bytes = 0
+    for path in image_paths:
+        size = _inline_request_size(path)
+        if job and job_bytes + size > max_bytes:
+            jobs.append(job)
+            job, job_bytes = [], 0
+        job.append(path)
+        job_bytes += size
+    if job:
+        jobs.append(job)
+    return jobs
+
+
+def run_batch(image_paths: List[str], poll_interval: float = 10.0, max_poll_interval: float = 300.0) -> dict:
+    """
+    Processes a backlog of receipt images offline with the Gemini Batch API.
+
+    The OCR prompts are submitted as inline batch jobs, which are billed at a
+    discount in exchange for higher latency. Inline requests are capped at
+    20 MB per job, so the images are split into jobs of at most
+    `MAX_INLINE_BATCH_BYTES` (estimated after base64 encoding), and only one
+    job's images are read into memory at a time. An image that exceeds the cap
+    on its own is still sent as a job by itself and will likely be rejected.
+    The receipts are then written to BigQuery with `log_expenses_batch`, which
+    assigns categories locally, so no further LLM calls are made.
+
+    Inline batch requests are only supported by the Gemini Developer API, so
+    this requires a `GOOGLE_API_KEY` rather than Vertex AI credentials.
+
+    Args:
+        image_paths (List[str]): Paths to the receipt images to process.
+        poll_interval (float): Initial delay, in seconds, between job status checks.
+        max_poll_interval (float): Upper bound for the exponential backoff.
+
+    Returns:
+        dict: The BigQuery logging status plus the image paths that could not be processed.
+    """
+    client = genai.Client()
+    jobs = []
+    for paths in _split_by_request_size(image_paths, MAX_INLINE_BATCH_BYTES):
+        job = client.batches.create(
+            model=BATCH_OCR_MODEL,
+            src=[_inline_request_for(path) for path in paths],
+            config={"display_name": "receipt-ocr-batch"},
+        )
+        logger.info("Submitted batch job %s for %d receipts.", job.name, len(paths))
+        jobs.append((paths, job))
+
+    receipts = []
+    failed = []
+    job_errors = []
+    for paths, job in jobs:
+        delay = poll_interval
+        while job.state.name not in _BATCH_DONE_STATES:
+            time.sleep(delay)
+            delay = min(delay * 2, max_poll_interval)
+            job = client.batches.get(name=job.name)
+            logger.debug("Batch job %s is %s.", job.name, job.state.name)
+
+        if job.state.name not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+            message = f"Batch job {job.name} ended in state {job.state.name}: {job.error}"
+            logger.error(message)
+            job_errors.append(message)
+            failed.extend(paths)
+            continue
+
+        for path, inlined in zip(paths, job.dest.inlined_responses):
+            if inlined.error or inlined.response is None:
+                failed.append(path)
+                continue
+            try:
+                receipts.append(Receipt.model_validate_json(inlined.response.text))
+            except Exception as e:
+                logger.warning("Could not parse OCR output for %s: %s", path, e)
+                failed.append(path)
+
+    if job_errors and not receipts:
+        return {"status": "error", "message": "; ".join(job_errors), "failed_images": failed}
+    result = log_expenses_batch(receipts) if receipts else {"status": "success", "row_count": 0}
+    result["failed_images"] = failed
+    return result
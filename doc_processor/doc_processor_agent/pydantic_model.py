@@ -1,12 +1,16 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Optional
 
 class LineItem(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
     description: str = Field(description="Description of the item purchased.")
     quantity: int = Field(description="Quantity of the item purchased.")
     price: float = Field(description="Price of the item purchased.")
 
 class Receipt(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid')
+
     vendor_name: str = Field(description="Name of the vendor or store.")
     transaction_date: str = Field(description="Date of the transaction in YYYY-MM-DD format.")
     total_amount: float = Field(description="Total amount of the transaction.")
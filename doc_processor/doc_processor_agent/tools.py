@@ -1,81 +1,702 @@
 import os
+import re
+import asyncio
+import datetime
+import logging
+import threading
+import uuid
+import weakref
+from typing import Dict, Iterable, List, Optional, Tuple
+import google.auth
+from google.api_core import exceptions as api_exceptions
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import bigquery
+from google.cloud import storage
+from google.cloud import bigquery_storage_v1
+from google.cloud.bigquery_storage_v1 import types, writer
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from .pydantic_model import Receipt
 from google.adk.tools import ToolContext
-import json
 
-def log_expense_to_bigquery(receipt: Receipt, tool_context: ToolContext) -> dict:
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = os.environ.get("GCP_PROJECT_ID", "aclarity-saas-platform")
+DATASET_ID = "finance_data"
+TABLE_ID = "expenses"
+
+# The Storage Write API accepts up to 10 MB per append request; leave some
+# headroom for the request envelope.
+MAX_BATCH_BYTES = 9 * 1024 * 1024
+
+# Limits for the batches the async flusher builds from queued tool calls.
+QUEUE_BATCH_MAX_ROWS = 500
+QUEUE_BATCH_MAX_WAIT_SECONDS = 0.1
+
+# Batches larger than this are written with a load job from GCS instead of
+# being streamed, when a staging location is configured.
+BULK_LOAD_THRESHOLD = 1000
+# GCS prefix (e.g. gs://my-bucket/staging) used to stage bulk load files.
+GCS_STAGING_URI = os.environ.get("EXPENSES_GCS_STAGING_URI")
+
+# Credentials are resolved once and the resulting authorized session is shared
+# by every REST client, so its connection pool keeps TCP/TLS connections warm
+# across calls instead of each client opening its own.
+# The session bypasses each client's own scoping of the credentials, so request
+# the scope they all need up front.
+_AUTH_SCOPES = ("https://www.googleapis.com/auth/cloud-platform",)
+_CREDENTIALS = None
+_HTTP_SESSION: Optional[AuthorizedSession] = None
+_AUTH_LOCK = threading.Lock()
+
+
+def _get_auth():
+    """
+    Returns the process-wide application default credentials and HTTP session.
+
+    Returns:
+        tuple: The credentials and an `AuthorizedSession` built from them.
+    """
+    global _CREDENTIALS, _HTTP_SESSION
+    with _AUTH_LOCK:
+        if _HTTP_SESSION is None:
+            _CREDENTIALS, _ = google.auth.default(scopes=_AUTH_SCOPES)
+            _HTTP_SESSION = AuthorizedSession(_CREDENTIALS)
+        return _CREDENTIALS, _HTTP_SESSION
+
+
+_EXPENSE_SCHEMA = (
+    bigquery.SchemaField("vendor_name", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("transaction_date", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("total_amount", "FLOAT", mode="REQUIRED"),
+    bigquery.SchemaField("category", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("line_items", "RECORD", mode="REPEATED", fields=(
+        bigquery.SchemaField("description", "STRING"),
+        bigquery.SchemaField("quantity", "INTEGER"),
+        bigquery.SchemaField("price", "FLOAT"),
+    )),
+)
+# Built once at import so creating the table on a cold start doesn't have to
+# construct any of these objects.
+_DATASET_REF = bigquery.DatasetReference(PROJECT_ID, DATASET_ID)
+_EXPENSE_TABLE_REF = _DATASET_REF.table(TABLE_ID)
+_EXPENSE_TABLE = bigquery.Table(_EXPENSE_TABLE_REF, schema=_EXPENSE_SCHEMA)
+
+
+# The client and the dataset/table existence checks are shared by the whole
+# process, so the insert path only ever issues the insert RPC itself.
+_CLIENT: Optional[bigquery.Client] = None
+_CLIENT_LOCK = threading.Lock()
+_TABLE_READY: bool = False
+_TABLE_LOCK = threading.Lock()
+
+
+def _get_client() -> bigquery.Client:
+    """Returns the process-wide BigQuery client, creating it on first use."""
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            credentials, http = _get_auth()
+            _CLIENT = bigquery.Client(project=PROJECT_ID, credentials=credentials, _http=http)
+        return _CLIENT
+
+
+def _line_items_is_json_string(table: bigquery.Table) -> bool:
+    """Whether the table still uses the old JSON string line_items column."""
+    return any(field.name == "line_items" and field.field_type == "STRING" for field in table.schema)
+
+
+def _ensure_table():
+    """
+    Creates the BigQuery client and makes sure the dataset and table exist.
+
+    The work is done once per process; later calls return the cached objects.
+
+    Returns:
+        tuple: The shared `bigquery.Client` and the expenses table reference.
+    """
+    global _TABLE_READY
+    if _TABLE_READY:
+        return _CLIENT, _EXPENSE_TABLE_REF
+
+    with _TABLE_LOCK:
+        if _TABLE_READY:
+            return _CLIENT, _EXPENSE_TABLE_REF
+
+        client = _get_client()
+
+        # Ensure dataset exists
+        try:
+            client.get_dataset(_DATASET_REF)
+        except api_exceptions.NotFound:
+            logger.info("Dataset %s not found, creating it.", DATASET_ID)
+            dataset = bigquery.Dataset(_DATASET_REF)
+            client.create_dataset(dataset, timeout=30)
+
+        # Ensure table exists
+        logger.debug("Checking for table %s in dataset %s...", TABLE_ID, DATASET_ID)
+        try:
+            table = client.get_table(_EXPENSE_TABLE_REF)
+        except api_exceptions.NotFound:
+            logger.info("Table %s not found, creating it.", TABLE_ID)
+            table = None
+
+        # Tables created before line_items became a nested field stored it as a
+        # JSON string. Rows encoded for the new schema can't be written to them,
+        # and migrating is a one-off job, so refuse to start instead.
+        if table is not None and _line_items_is_json_string(table):
+            raise RuntimeError(
+                f"Table {TABLE_ID} still stores line_items as a JSON string; "
+                "run migrate_line_items_schema() once before logging expenses."
+            )
+
+        if table is None:
+            client.create_table(_EXPENSE_TABLE, exists_ok=True, timeout=30)
+
+        _TABLE_READY = True
+        return client, _EXPENSE_TABLE_REF
+
+
+def _add_fields(descriptor: descriptor_pb2.DescriptorProto, fields: list) -> None:
+    for number, (name, field_type, label, type_name) in enumerate(fields, start=1):
+        descriptor.field.add(name=name, number=number, type=field_type, label=label, type_name=type_name)
+
+
+def _build_expense_row_descriptor() -> descriptor_pb2.DescriptorProto:
+    """Builds the protobuf descriptor mirroring the expenses table schema."""
+    field_proto = descriptor_pb2.FieldDescriptorProto
+    descriptor = descriptor_pb2.DescriptorProto(name="ExpenseRow")
+    line_item = descriptor.nested_type.add(name="LineItem")
+    _add_fields(line_item, [
+        ("description", field_proto.TYPE_STRING, field_proto.LABEL_OPTIONAL, None),
+        ("quantity", field_proto.TYPE_INT64, field_proto.LABEL_OPTIONAL, None),
+        ("price", field_proto.TYPE_DOUBLE, field_proto.LABEL_OPTIONAL, None),
+    ])
+    _add_fields(descriptor, [
+        ("vendor_name", field_proto.TYPE_STRING, field_proto.LABEL_OPTIONAL, None),
+        # DATE columns are written as the number of days since the Unix epoch.
+        ("transaction_date", field_proto.TYPE_INT32, field_proto.LABEL_OPTIONAL, None),
+        ("total_amount", field_proto.TYPE_DOUBLE, field_proto.LABEL_OPTIONAL, None),
+        ("category", field_proto.TYPE_STRING, field_proto.LABEL_OPTIONAL, None),
+        ("line_items", field_proto.TYPE_MESSAGE, field_proto.LABEL_REPEATED, "LineItem"),
+    ])
+    return descriptor
+
+
+# The writer schema sent to BigQuery. BigQuery rebuilds it into a file without
+# a package, so nested types must be referenced by their relative name rather
+# than the fully qualified one a resolved descriptor would carry.
+_ROW_DESCRIPTOR = _build_expense_row_descriptor()
+
+_row_file = descriptor_pb2.FileDescriptorProto(name="expense_row.proto", package="doc_processor")
+_row_file.message_type.add().CopyFrom(_ROW_DESCRIPTOR)
+_row_pool = descriptor_pool.DescriptorPool()
+_row_pool.Add(_row_file)
+ExpenseRow = message_factory.GetMessageClass(_row_pool.FindMessageTypeByName("doc_processor.ExpenseRow"))
+
+_EPOCH = datetime.date(1970, 1, 1)
+
+_WRITE_CLIENT: Optional[bigquery_storage_v1.BigQueryWriteClient] = None
+_APPEND_STREAM: Optional[writer.AppendRowsStream] = None
+_STREAM_LOCK = threading.Lock()
+
+
+def _get_append_stream() -> writer.AppendRowsStream:
+    """
+    Returns the process-wide append stream on the table's default write stream.
+
+    The bidirectional gRPC stream is opened on first use and kept open so that
+    later appends don't pay the connection setup cost again.
+    """
+    global _WRITE_CLIENT, _APPEND_STREAM
+    with _STREAM_LOCK:
+        if _APPEND_STREAM is None:
+            _ensure_table()
+            if _WRITE_CLIENT is None:
+                _WRITE_CLIENT = bigquery_storage_v1.BigQueryWriteClient(credentials=_get_auth()[0])
+            table_path = _WRITE_CLIENT.table_path(PROJECT_ID, DATASET_ID, TABLE_ID)
+
+            proto_data = types.AppendRowsRequest.ProtoData()
+            proto_data.writer_schema = types.ProtoSchema(proto_descriptor=_ROW_DESCRIPTOR)
+            # The default stream has at-least-once semantics and, like
+            # insertAll without insertIds, skips server-side deduplication to
+            # get the highest throughput tier. A retried append can therefore
+            # write a row twice; `dedupe_expenses` cleans those up.
+            request_template = types.AppendRowsRequest(
+                write_stream=f"{table_path}/streams/_default",
+                proto_rows=proto_data,
+            )
+            _APPEND_STREAM = writer.AppendRowsStream(_WRITE_CLIENT, request_template)
+        return _APPEND_STREAM
+
+
+def _reset_append_stream() -> None:
+    """Closes the shared append stream so the next append reopens it."""
+    global _APPEND_STREAM
+    with _STREAM_LOCK:
+        if _APPEND_STREAM is not None:
+            try:
+                _APPEND_STREAM.close()
+            except Exception:
+                pass
+            _APPEND_STREAM = None
+
+
+@retry(
+    wait=wait_exponential_jitter(initial=0.1, max=5),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type(api_exceptions.ServiceUnavailable),
+    reraise=True,
+)
+def _append_serialized_rows(rows: List[bytes]) -> list:
+    """
+    Appends protobuf-encoded rows to the expenses table and waits for the ack.
+
+    Appends that fail because the service is briefly unavailable are retried
+    with jittered exponential backoff on a freshly opened stream.
+
+    Returns:
+        list: The row errors reported by BigQuery (empty on success).
+    """
+    request = types.AppendRowsRequest(
+        proto_rows=types.AppendRowsRequest.ProtoData(
+            rows=types.ProtoRows(serialized_rows=rows)
+        )
+    )
+    try:
+        response = _get_append_stream().send(request).result()
+    except Exception:
+        _reset_append_stream()
+        raise
+    return [str(error) for error in response.row_errors]
+
+
+def _append_rows_in_chunks(rows: List[bytes]) -> list:
+    """
+    Appends serialized rows using as few requests as `MAX_BATCH_BYTES` allows.
+
+    Returns:
+        list: The row errors reported by BigQuery (empty on success).
+    """
+    errors = []
+    chunk: List[bytes] = []
+    chunk_bytes = 0
+    for row in rows:
+        if chunk and chunk_bytes + len(row) > MAX_BATCH_BYTES:
+            errors.extend(_append_serialized_rows(chunk))
+            chunk, chunk_bytes = [], 0
+        chunk.append(row)
+        chunk_bytes += len(row)
+    if chunk:
+        errors.extend(_append_serialized_rows(chunk))
+    if errors:
+        logger.error("Encountered errors while inserting rows: %s", errors)
+    return errors
+
+
+def _as_receipt(receipt) -> Receipt:
+    """
+    Returns the input as a `Receipt`, only validating when it isn't one already.
+
+    `Receipt` instances are passed through unchanged. Dicts, such as
+    function-call arguments produced by a model, are validated so values like
+    `"12.50"` or `1.0` are coerced to the field types before encoding.
+    """
+    if isinstance(receipt, Receipt):
+        return receipt
+    return Receipt.model_validate(receipt)
+
+
+def _encode_row(receipt_obj: Receipt) -> bytes:
+    """Encodes a receipt as a serialized `ExpenseRow` protobuf message."""
+    row_to_insert = ExpenseRow(
+        vendor_name=receipt_obj.vendor_name,
+        transaction_date=(datetime.date.fromisoformat(receipt_obj.transaction_date) - _EPOCH).days,
+        total_amount=receipt_obj.total_amount,
+        category=receipt_obj.category,
+        line_items=[item.__dict__ for item in receipt_obj.line_items],
+    )
+    logger.debug("Encoding row: %s", row_to_insert)
+    return row_to_insert.SerializeToString()
+
+
+def _keyword_pattern(*keywords: str) -> re.Pattern:
+    """Compiles keywords into one case-insensitive, whole-word alternation."""
+    return re.compile(r"\b(?:" + "|".join(map(re.escape, keywords)) + r")s?\b", re.IGNORECASE)
+
+
+# Checked in order, first against the vendor name and then against the line
+# item descriptions; the first category whose pattern matches wins. Dining
+# comes first so restaurant names that mention another category ("Market
+# Street Grill", "Uber Eats") aren't filed under it.
+CATEGORY_RULES: Dict[str, re.Pattern] = {
+    "Dining": _keyword_pattern(
+        "restaurant", "cafe", "coffee", "starbucks", "mcdonald", "pizza", "burger", "grill", "bistro", "bar",
+        "diner", "sushi", "taco", "uber eats", "doordash", "grubhub",
+    ),
+    "Fuel": _keyword_pattern(
+        "shell", "chevron", "exxon", "mobil", "bp", "texaco", "gas station", "fuel", "gasoline", "diesel", "petrol",
+    ),
+    "Groceries": _keyword_pattern(
+        "walmart", "kroger", "safeway", "whole foods", "trader joe", "aldi", "costco", "grocery", "groceries",
+        "supermarket", "market",
+    ),
+    "Travel": _keyword_pattern(
+        "airline", "airways", "hotel", "inn", "marriott", "hilton", "uber", "lyft", "taxi", "car rental", "flight",
+        "train", "parking",
+    ),
+    "Entertainment": _keyword_pattern(
+        "cinema", "theater", "theatre", "movie", "concert", "ticket", "museum", "netflix", "spotify",
+    ),
+}
+
+
+def classify_category(receipt: Receipt) -> str:
+    """
+    Classifies a receipt into an expense category with precompiled keyword rules.
+
+    The vendor name decides when it matches any rule; line item descriptions
+    are only consulted otherwise, so a coffee bought at a grocery store still
+    counts as Groceries.
+
+    Args:
+        receipt (Receipt): The receipt to classify.
+
+    Returns:
+        str: One of Dining, Groceries, Fuel, Travel, Entertainment, or Other.
+    """
+    line_item_text = " ".join(item.description for item in receipt.line_items)
+    for text in (receipt.vendor_name, line_item_text):
+        for category, pattern in CATEGORY_RULES.items():
+            if pattern.search(text):
+                return category
+    return "Other"
+
+
+def _with_category(receipt_obj: Receipt) -> Receipt:
+    """Returns the receipt with a category, classifying it if it has none."""
+    if receipt_obj.category:
+        return receipt_obj
+    return receipt_obj.model_copy(update={"category": classify_category(receipt_obj)})
+
+
+# Rows queued by concurrent tool calls, each paired with the future its caller
+# awaits. asyncio objects can't be shared between event loops (ADK's sync
+# Runner.run drives each run on its own loop and thread), so every loop gets
+# its own queue and flusher task.
+_FLUSHERS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Tuple[asyncio.Queue, asyncio.Task]]" = (
+    weakref.WeakKeyDictionary()
+)
+_FLUSHERS_LOCK = threading.Lock()
+
+
+async def _flusher(queue: asyncio.Queue) -> None:
+    """
+    Drains the insert queue, appending up to `QUEUE_BATCH_MAX_ROWS` rows at a time.
+
+    A batch is sent as soon as it is full (by row count or `MAX_BATCH_BYTES`)
+    or `QUEUE_BATCH_MAX_WAIT_SECONDS` after its first row arrived, which
+    bounds the latency added to each call.
+    """
+    loop = asyncio.get_running_loop()
+    carried_over = None
+    while True:
+        item = carried_over if carried_over is not None else await queue.get()
+        carried_over = None
+        batch = [item]
+        batch_bytes = len(item[0])
+        deadline = loop.time() + QUEUE_BATCH_MAX_WAIT_SECONDS
+        while len(batch) < QUEUE_BATCH_MAX_ROWS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if batch_bytes + len(item[0]) > MAX_BATCH_BYTES:
+                # Starts the next batch instead of overflowing this one.
+                carried_over = item
+                break
+            batch.append(item)
+            batch_bytes += len(item[0])
+
+        logger.debug("Flushing %d queued rows to BigQuery...", len(batch))
+        try:
+            # The Storage Write API rejects the whole append if any row is
+            # invalid, so the outcome is shared by every row in the batch.
+            outcome = await asyncio.to_thread(_append_serialized_rows, [row for row, _ in batch])
+        except Exception as e:
+            logger.exception("An error occurred while flushing rows to BigQuery: %s", e)
+            outcome = e
+        else:
+            if outcome:
+                logger.error("Encountered errors while inserting rows: %s", outcome)
+        for _, future in batch:
+            if future.done():
+                continue
+            if isinstance(outcome, Exception):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+
+def _get_insert_queue(loop: asyncio.AbstractEventLoop) -> asyncio.Queue:
+    """Returns the insert queue for `loop`, starting its flusher on first use."""
+    with _FLUSHERS_LOCK:
+        # The flusher task references its loop, so entries for closed loops
+        # would otherwise never be released.
+        for closed_loop in [other for other in _FLUSHERS if other.is_closed()]:
+            del _FLUSHERS[closed_loop]
+        entry = _FLUSHERS.get(loop)
+        if entry is None or entry[1].done():
+            queue = asyncio.Queue()
+            entry = (queue, loop.create_task(_flusher(queue)))
+            _FLUSHERS[loop] = entry
+        return entry[0]
+
+
+async def _enqueue_row(row: bytes) -> list:
+    """
+    Queues a serialized row for the background flusher and waits for its batch.
+
+    Returns:
+        list: The row errors reported by BigQuery for the batch (empty on success).
+    """
+    loop = asyncio.get_running_loop()
+    queue = _get_insert_queue(loop)
+    future = loop.create_future()
+    await queue.put((row, future))
+    return await future
+
+
+async def log_expense_to_bigquery(receipt: Receipt, tool_context: Optional[ToolContext] = None) -> dict:
     """
     Logs a receipt's data into a BigQuery table.
 
+    Receipts without a category are classified with `classify_category`. The
+    row is then encoded as a protobuf message and queued; a background task
+    batches it with rows from concurrent calls into a single Storage Write API
+    append, and this call returns once that batch is committed. The append
+    itself runs on a worker thread so the event loop stays free.
+
     Args:
         receipt (Receipt): The Pydantic model containing the receipt data.
-        tool_context (ToolContext): The context provided by the ADK framework.
+        tool_context (Optional[ToolContext]): The context provided by the ADK framework, when called as a tool.
 
     Returns:
         dict: A dictionary with the status of the operation and the inserted record ID.
     """
     try:
-        print("########### Starting log_expense_to_bigquery...")
-        # --- FIX: Instantiate the Pydantic model from the input dictionary ---
+        logger.debug("Starting log_expense_to_bigquery...")
         try:
-            receipt_obj = Receipt(**receipt)
+            receipt_obj = _as_receipt(receipt)
         except Exception as pydantic_error:
-            print(f"Error creating Receipt model from dict: {pydantic_error}")
+            logger.warning("Error creating Receipt model from dict: %s", pydantic_error)
             return {"status": "error", "message": f"Invalid receipt data structure: {pydantic_error}"}
-        # --- END FIX ---
-        project_id = os.environ.get("GCP_PROJECT_ID", "aclarity-saas-platform")
-        dataset_id = "finance_data"
-        table_id = "expenses"
 
-        client = bigquery.Client(project=project_id)
+        # Prepare data for insertion
+        logger.debug("Preparing data for insertion...")
+        receipt_obj = _with_category(receipt_obj)
+        logger.debug("Receipt data: %s", receipt_obj)
+        errors = await _enqueue_row(_encode_row(receipt_obj))
+        if errors:
+            return {"status": "error", "message": str(errors)}
+        logger.debug("New expense record has been added to BigQuery.")
+        # In a real scenario, you might query for the inserted ID
+        return {"status": "success", "record_id": "simulated_id_12345"}
+    except Exception as e:
+        logger.exception("An error occurred while logging to BigQuery: %s", e)
+        return {"status": "error", "message": str(e)}
 
-        # Ensure dataset exists
-        dataset_ref = client.dataset(dataset_id)
-        try:
-            client.get_dataset(dataset_ref)
-        except Exception:
-            print(f"Dataset {dataset_id} not found, creating it.")
-            dataset = bigquery.Dataset(dataset_ref)
-            client.create_dataset(dataset, timeout=30)
 
-        # Ensure table exists
-        table_ref = dataset_ref.table(table_id)
-        print(f"########### Checking for table {table_id} in dataset {dataset_id}...")
-        try:
-            client.get_table(table_ref)
-        except Exception:
-            print(f"Table {table_id} not found, creating it.")
-            schema = [
-                bigquery.SchemaField("vendor_name", "STRING", mode="REQUIRED"),
-                bigquery.SchemaField("transaction_date", "DATE", mode="REQUIRED"),
-                bigquery.SchemaField("total_amount", "FLOAT", mode="REQUIRED"),
-                bigquery.SchemaField("category", "STRING", mode="REQUIRED"),
-                bigquery.SchemaField("line_items", "STRING", mode="NULLABLE"), # Storing as JSON string
-            ]
-            table = bigquery.Table(table_ref, schema=schema)
-            client.create_table(table, timeout=30)
+def bulk_load_expenses(receipts: Iterable[Receipt], gcs_staging: str) -> dict:
+    """
+    Loads receipts into BigQuery with a load job staged through GCS.
 
-        # Prepare data for insertion
-        print("########### Preparing data for insertion...")
-        print(f"##############Receipt data: {receipt_obj}")
-        line_items_json = json.dumps([item.model_dump() for item in receipt_obj.line_items])
-        row_to_insert = {
-            "vendor_name": receipt_obj.vendor_name,
-            "transaction_date": receipt_obj.transaction_date,
-            "total_amount": receipt_obj.total_amount,
-            "category": receipt_obj.category,
-            "line_items": line_items_json
-        }
-        print(f"Inserting row: {row_to_insert}")
-        errors = client.insert_rows_json(table_ref, [row_to_insert])
-        if not errors:
-            print("New expense record has been added to BigQuery.")
-            # In a real scenario, you might query for the inserted ID
-            return {"status": "success", "record_id": "simulated_id_12345"}
-        else:
-            print(f"Encountered errors while inserting rows: {errors}")
+    Load jobs are free and aren't subject to streaming quotas, which makes
+    them the better fit for large backfills. The receipts are classified if
+    needed and streamed into a newline-delimited JSON file under
+    `gcs_staging`, without holding the whole file in memory. The file is then
+    loaded into the expenses table and deleted afterwards.
+
+    Args:
+        receipts (Iterable[Receipt]): The receipts to load.
+        gcs_staging (str): GCS prefix for the staging file, e.g. `gs://bucket/staging`.
+
+    Returns:
+        dict: A dictionary with the status of the operation and the number of rows loaded,
+        or an error message.
+    """
+    blob = None
+    try:
+        client, table_ref = _ensure_table()
+        bucket_name, _, prefix = gcs_staging.removeprefix("gs://").partition("/")
+        blob_name = "/".join(filter(None, [prefix.rstrip("/"), f"batch-{uuid.uuid4().hex}.ndjson"]))
+        credentials, http = _get_auth()
+        storage_client = storage.Client(project=PROJECT_ID, credentials=credentials, _http=http)
+        blob = storage_client.bucket(bucket_name).blob(blob_name)
+
+        with blob.open("w", content_type="application/x-ndjson") as ndjson:
+            for receipt in receipts:
+                ndjson.write(_with_category(receipt).model_dump_json())
+                ndjson.write("\n")
+        gcs_uri = f"gs://{bucket_name}/{blob_name}"
+        logger.info("Loading %s into %s.", gcs_uri, TABLE_ID)
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        job = client.load_table_from_uri(gcs_uri, table_ref, job_config=job_config)
+        job.result()
+        return {"status": "success", "row_count": job.output_rows}
+    except Exception as e:
+        logger.exception("An error occurred while bulk loading to BigQuery: %s", e)
+        return {"status": "error", "message": str(e)}
+    finally:
+        # Closing the writer after a failed write still finalizes a partial
+        # file, so clean up whatever was uploaded.
+        if blob is not None:
+            try:
+                blob.delete()
+            except api_exceptions.NotFound:
+                pass
+
+
+def log_expenses_batch(receipts: List[Receipt], gcs_staging: Optional[str] = None) -> dict:
+    """
+    Logs many receipts into BigQuery at once.
+
+    Batches above `BULK_LOAD_THRESHOLD` rows go through `bulk_load_expenses`
+    when a GCS staging location is available. Receipts without a category are
+    classified with `classify_category`. Smaller batches are encoded up
+    front and streamed with as few appends as the request size limit allows,
+    instead of one append per receipt.
+
+    Args:
+        receipts (List[Receipt]): The receipts to log.
+        gcs_staging (Optional[str]): GCS prefix for bulk load files. Defaults to
+            the `EXPENSES_GCS_STAGING_URI` environment variable.
+
+    Returns:
+        dict: A dictionary with the status of the operation and the number of rows written.
+    """
+    gcs_staging = gcs_staging or GCS_STAGING_URI
+    try:
+        if len(receipts) > BULK_LOAD_THRESHOLD and gcs_staging:
+            return bulk_load_expenses(receipts, gcs_staging)
+        errors = _append_rows_in_chunks([_encode_row(_with_category(receipt)) for receipt in receipts])
+        if errors:
             return {"status": "error", "message": str(errors)}
+        return {"status": "success", "row_count": len(receipts)}
+    except Exception as e:
+        logger.exception("An error occurred while logging to BigQuery: %s", e)
+        return {"status": "error", "message": str(e)}
+
+
+# Expenses are considered duplicates when vendor, date and total all match.
+# Keeps one copy of each duplicated expense and removes the rest. BigQuery
+# can't partition on FLOAT64, so totals are compared as NUMERIC.
+DEDUPE_EXPENSES_SQL = """
+BEGIN TRANSACTION;
+
+CREATE TEMP TABLE duplicates AS
+SELECT * EXCEPT (row_num, copies)
+FROM (
+  SELECT
+    *,
+    ROW_NUMBER() OVER dedupe_key AS row_num,
+    COUNT(*) OVER dedupe_key AS copies
+  FROM `{table}`
+  WINDOW dedupe_key AS (PARTITION BY vendor_name, transaction_date, CAST(total_amount AS NUMERIC))
+)
+WHERE copies > 1 AND row_num = 1;
+
+DELETE FROM `{table}` AS expense
+WHERE EXISTS (
+  SELECT 1 FROM duplicates AS dup
+  WHERE dup.vendor_name = expense.vendor_name
+    AND dup.transaction_date = expense.transaction_date
+    AND CAST(dup.total_amount AS NUMERIC) = CAST(expense.total_amount AS NUMERIC)
+);
+
+INSERT INTO `{table}` SELECT * FROM duplicates;
+
+COMMIT TRANSACTION;
+"""
+
+
+def dedupe_expenses() -> dict:
+    """
+    Removes duplicate expense rows left behind by retried appends.
+
+    Meant to run nightly (e.g. from Cloud Scheduler or as a BigQuery
+    scheduled query using `DEDUPE_EXPENSES_SQL`).
+
+    Returns:
+        dict: A dictionary with the status of the operation.
+    """
+    client, table_ref = _ensure_table()
+    table = f"{table_ref.project}.{table_ref.dataset_id}.{table_ref.table_id}"
+    try:
+        client.query(DEDUPE_EXPENSES_SQL.format(table=table)).result()
+        return {"status": "success"}
+    except Exception as e:
+        logger.exception("An error occurred while deduplicating expenses: %s", e)
+        return {"status": "error", "message": str(e)}
+
+
+# Rewrites a table that stores line_items as a JSON string into the current
+# schema, parsing each item into the repeated record. The original table is
+# kept as a copy in `{backup}`.
+MIGRATE_LINE_ITEMS_SQL = """
+CREATE TABLE IF NOT EXISTS `{backup}` COPY `{table}`;
+
+CREATE OR REPLACE TABLE `{table}` (
+  vendor_name STRING NOT NULL,
+  transaction_date DATE NOT NULL,
+  total_amount FLOAT64 NOT NULL,
+  category STRING NOT NULL,
+  line_items ARRAY<STRUCT<description STRING, quantity INT64, price FLOAT64>>
+) AS
+SELECT
+  vendor_name,
+  transaction_date,
+  total_amount,
+  category,
+  ARRAY(
+    SELECT AS STRUCT
+      JSON_VALUE(item, '$.description') AS description,
+      CAST(SAFE_CAST(JSON_VALUE(item, '$.quantity') AS FLOAT64) AS INT64) AS quantity,
+      SAFE_CAST(JSON_VALUE(item, '$.price') AS FLOAT64) AS price
+    FROM UNNEST(JSON_QUERY_ARRAY(line_items)) AS item
+  ) AS line_items
+FROM `{table}`;
+"""
+
+
+def migrate_line_items_schema() -> dict:
+    """
+    Migrates an expenses table with JSON string line_items to the nested schema.
+
+    This is a one-off operation to run by hand (with writers stopped) before
+    deploying the nested line_items schema. Existing rows are kept: their
+    line_items JSON is parsed into the repeated record, and a copy of the
+    original table is left in `<table>_line_items_json_backup`. Running it
+    against an already migrated table does nothing.
+
+    Returns:
+        dict: A dictionary with the status of the operation.
+    """
+    client = _get_client()
+    if not _line_items_is_json_string(client.get_table(_EXPENSE_TABLE_REF)):
+        return {"status": "success", "message": f"Table {TABLE_ID} is already migrated."}
+
+    table = f"{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}"
+    logger.warning("Migrating %s.line_items to a repeated record.", table)
+    try:
+        client.query(MIGRATE_LINE_ITEMS_SQL.format(table=table, backup=f"{table}_line_items_json_backup")).result()
+        return {"status": "success", "message": f"Table {TABLE_ID} migrated."}
     except Exception as e:
-        print(f"An error occurred while logging to BigQuery: {e}")
+        logger.exception("An error occurred while migrating %s: %s", table, e)
         return {"status": "error", "message": str(e)}
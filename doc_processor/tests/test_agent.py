@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from doc_processor_agent import agent
+
+
+def make_images(tmp_path, sizes):
+    paths = []
+    for index, size in enumerate(sizes):
+        path = tmp_path / f"receipt-{index}.png"
+        path.write_bytes(b"\0" * size)
+        paths.append(str(path))
+    return paths
+
+
+def test_split_by_request_size_bounds_each_job(tmp_path):
+    paths = make_images(tmp_path, [3000, 3000, 3000, 30000])
+    max_bytes = 2 * agent._inline_request_size(paths[0])
+
+    assert agent._split_by_request_size(paths, max_bytes) == [paths[:2], paths[2:3], paths[3:]]
+
+
+def test_run_batch_submits_one_job_per_split(tmp_path, monkeypatch):
+    paths = make_images(tmp_path, [3000, 3000, 3000])
+    monkeypatch.setattr(agent, "MAX_INLINE_BATCH_BYTES", 2 * agent._inline_request_size(paths[0]))
+    receipt_json = (
+        '{"vendor_name": "Kroger", "transaction_date": "2024-01-02", "total_amount": 3.5, "line_items": []}'
+    )
+
+    def create(model, src, config):
+        responses = [SimpleNamespace(error=None, response=SimpleNamespace(text=receipt_json)) for _ in src]
+        return SimpleNamespace(
+            name=f"batches/{len(src)}",
+            state=SimpleNamespace(name="JOB_STATE_SUCCEEDED"),
+            dest=SimpleNamespace(inlined_responses=responses),
+        )
+
+    client = mock.Mock()
+    client.batches.create.side_effect = create
+    monkeypatch.setattr(agent.genai, "Client", mock.Mock(return_value=client))
+    log_expenses_batch = mock.Mock(return_value={"status": "success", "row_count": 3})
+    monkeypatch.setattr(agent, "log_expenses_batch", log_expenses_batch)
+
+    result = agent.run_batch(paths)
+
+    assert [len(call.kwargs["src"]) for call in client.batches.create.call_args_list] == [2, 1]
+    assert result == {"status": "success", "row_count": 3, "failed_images": []}
+    receipts = log_expenses_batch.call_args.args[0]
+    assert len(receipts) == 3 and all(receipt.category is None for receipt in receipts)
@@ -0,0 +1,326 @@
+import asyncio
+import io
+import json
+import threading
+from unittest import mock
+
+import pytest
+
+from doc_processor_agent import tools
+from doc_processor_agent.pydantic_model import LineItem, Receipt
+
+
+def make_receipt(**overrides) -> Receipt:
+    fields = {
+        "vendor_name": "Kroger",
+        "transaction_date": "2024-01-02",
+        "total_amount": 3.5,
+        "line_items": [LineItem(description="Milk", quantity=1, price=3.5)],
+    }
+    fields.update(overrides)
+    return Receipt(**fields)
+
+
+def test_as_receipt_passes_receipt_through():
+    receipt = make_receipt()
+    assert tools._as_receipt(receipt) is receipt
+
+
+def test_as_receipt_coerces_dict_values():
+    receipt = tools._as_receipt({
+        "vendor_name": "Kroger",
+        "transaction_date": "2024-01-02",
+        "total_amount": "12.50",
+        "line_items": [{"description": "Milk", "quantity": 1.0, "price": "3.5"}],
+    })
+    assert receipt.total_amount == 12.5
+    assert receipt.line_items[0].quantity == 1
+    assert isinstance(receipt.line_items[0].quantity, int)
+    # Coerced values must be encodable.
+    tools._encode_row(receipt.model_copy(update={"category": "Groceries"}))
+
+
+def test_as_receipt_rejects_unknown_fields():
+    with pytest.raises(ValueError):
+        tools._as_receipt({**make_receipt().model_dump(), "tip": 2})
+
+
+@pytest.mark.parametrize(
+    ("vendor_name", "description", "category"),
+    [
+        ("Market Street Grill", "Burger", "Dining"),
+        ("Uber Eats", "Pad Thai", "Dining"),
+        ("Uber", "Trip to airport", "Travel"),
+        ("Whole Foods Market", "Coffee beans", "Groceries"),
+        ("Shell", "Unleaded", "Fuel"),
+        ("Hilton Garden Inn", "Room", "Travel"),
+        ("AMC", "Movie tickets", "Entertainment"),
+        ("Corner Shop", "Groceries", "Groceries"),
+        ("Acme Hardware", "Hammer", "Other"),
+    ],
+)
+def test_classify_category(vendor_name, description, category):
+    receipt = make_receipt(
+        vendor_name=vendor_name, line_items=[LineItem(description=description, quantity=1, price=3.5)]
+    )
+    assert tools.classify_category(receipt) == category
+
+
+def test_encode_row_encodes_date_and_line_items():
+    receipt = make_receipt(
+        category="Groceries",
+        line_items=[
+            LineItem(description="Milk", quantity=2, price=1.25),
+            LineItem(description="Bread", quantity=1, price=1.0),
+        ],
+    )
+
+    row = tools.ExpenseRow.FromString(tools._encode_row(receipt))
+
+    assert row.vendor_name == "Kroger"
+    # DATE columns take the number of days since the Unix epoch.
+    assert row.transaction_date == 19724
+    assert row.total_amount == 3.5
+    assert row.category == "Groceries"
+    assert [(item.description, item.quantity, item.price) for item in row.line_items] == [
+        ("Milk", 2, 1.25),
+        ("Bread", 1, 1.0),
+    ]
+
+
+def test_writer_schema_resolves_without_a_package():
+    from google.protobuf import descriptor_pb2, descriptor_pool
+
+    # BigQuery rebuilds the writer schema into a package-less file, so it has
+    # to resolve there on its own.
+    proto_file = descriptor_pb2.FileDescriptorProto(name="BqMessage.proto")
+    proto_file.message_type.add().CopyFrom(tools._ROW_DESCRIPTOR)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(proto_file)
+
+    line_items = pool.FindMessageTypeByName("ExpenseRow").fields_by_name["line_items"]
+    assert line_items.message_type.full_name == "ExpenseRow.LineItem"
+
+
+def make_table(line_items_type: str):
+    from google.cloud import bigquery
+    return bigquery.Table(
+        tools._EXPENSE_TABLE_REF,
+        schema=[bigquery.SchemaField("vendor_name", "STRING"), bigquery.SchemaField("line_items", line_items_type)],
+    )
+
+
+def test_ensure_table_refuses_legacy_json_schema(monkeypatch):
+    client = mock.Mock()
+    client.get_table.return_value = make_table("STRING")
+    monkeypatch.setattr(tools, "_get_client", lambda: client)
+    monkeypatch.setattr(tools, "_TABLE_READY", False)
+
+    with pytest.raises(RuntimeError, match="migrate_line_items_schema"):
+        tools._ensure_table()
+    client.delete_table.assert_not_called()
+    client.copy_table.assert_not_called()
+    assert tools._TABLE_READY is False
+
+
+def test_ensure_table_propagates_errors_other_than_not_found(monkeypatch):
+    from google.api_core import exceptions as api_exceptions
+
+    client = mock.Mock()
+    client.get_table.side_effect = api_exceptions.Forbidden("denied")
+    monkeypatch.setattr(tools, "_get_client", lambda: client)
+    monkeypatch.setattr(tools, "_TABLE_READY", False)
+
+    with pytest.raises(api_exceptions.Forbidden):
+        tools._ensure_table()
+    client.create_table.assert_not_called()
+    assert tools._TABLE_READY is False
+
+
+def test_ensure_table_creates_missing_table(monkeypatch):
+    from google.api_core import exceptions as api_exceptions
+
+    client = mock.Mock()
+    client.get_table.side_effect = api_exceptions.NotFound("missing")
+    monkeypatch.setattr(tools, "_get_client", lambda: client)
+    monkeypatch.setattr(tools, "_TABLE_READY", False)
+
+    assert tools._ensure_table() == (client, tools._EXPENSE_TABLE_REF)
+    client.create_table.assert_called_once_with(tools._EXPENSE_TABLE, exists_ok=True, timeout=30)
+
+
+def test_migrate_line_items_schema_rewrites_rows_in_place(monkeypatch):
+    client = mock.Mock()
+    client.get_table.return_value = make_table("STRING")
+    monkeypatch.setattr(tools, "_get_client", lambda: client)
+
+    assert tools.migrate_line_items_schema()["status"] == "success"
+    sql = client.query.call_args.args[0]
+    table = f"{tools.PROJECT_ID}.finance_data.expenses"
+    assert f"CREATE TABLE IF NOT EXISTS `{table}_line_items_json_backup` COPY `{table}`" in sql
+    assert f"CREATE OR REPLACE TABLE `{table}`" in sql
+    assert "UNNEST(JSON_QUERY_ARRAY(line_items))" in sql
+    client.delete_table.assert_not_called()
+
+
+def test_migrate_line_items_schema_skips_migrated_table(monkeypatch):
+    client = mock.Mock()
+    client.get_table.return_value = make_table("RECORD")
+    monkeypatch.setattr(tools, "_get_client", lambda: client)
+
+    assert tools.migrate_line_items_schema()["status"] == "success"
+    client.query.assert_not_called()
+
+
+class RecordingWriter(io.StringIO):
+    def close(self):
+        self.written = self.getvalue()
+        super().close()
+
+
+def test_bulk_load_expenses_streams_classified_rows(monkeypatch):
+    client = mock.Mock()
+    client.load_table_from_uri.return_value.output_rows = 2
+    monkeypatch.setattr(tools, "_ensure_table", lambda: (client, tools._EXPENSE_TABLE_REF))
+    monkeypatch.setattr(tools, "_get_auth", lambda: (None, None))
+    writer = RecordingWriter()
+    storage_client = mock.Mock()
+    blob = storage_client.bucket.return_value.blob.return_value
+    blob.open.return_value = writer
+    monkeypatch.setattr(tools.storage, "Client", mock.Mock(return_value=storage_client))
+
+    result = tools.bulk_load_expenses(
+        iter([make_receipt(), make_receipt(vendor_name="Shell", category="Travel")]),
+        "gs://bucket/staging/",
+    )
+
+    assert result == {"status": "success", "row_count": 2}
+    rows = [json.loads(line) for line in writer.written.splitlines()]
+    assert [row["category"] for row in rows] == ["Groceries", "Travel"]
+    blob_name = storage_client.bucket.return_value.blob.call_args.args[0]
+    assert blob_name.startswith("staging/batch-") and blob_name.endswith(".ndjson")
+    assert client.load_table_from_uri.call_args.args[0] == f"gs://bucket/{blob_name}"
+    blob.delete.assert_called_once()
+
+
+def test_bulk_load_expenses_deletes_partial_file_on_failure(monkeypatch):
+    client = mock.Mock()
+    monkeypatch.setattr(tools, "_ensure_table", lambda: (client, tools._EXPENSE_TABLE_REF))
+    monkeypatch.setattr(tools, "_get_auth", lambda: (None, None))
+    monkeypatch.setattr(tools, "_with_category", mock.Mock(side_effect=[make_receipt(), ValueError("bad row")]))
+    storage_client = mock.Mock()
+    blob = storage_client.bucket.return_value.blob.return_value
+    blob.open.return_value = RecordingWriter()
+    monkeypatch.setattr(tools.storage, "Client", mock.Mock(return_value=storage_client))
+
+    result = tools.bulk_load_expenses([make_receipt(), make_receipt()], "gs://bucket/staging")
+
+    assert result == {"status": "error", "message": "bad row"}
+    client.load_table_from_uri.assert_not_called()
+    blob.delete.assert_called_once()
+
+
+def test_get_auth_requests_cloud_platform_scope(monkeypatch):
+    default = mock.Mock(return_value=(mock.Mock(), "project"))
+    monkeypatch.setattr(tools.google.auth, "default", default)
+    monkeypatch.setattr(tools, "_HTTP_SESSION", None)
+
+    credentials, session = tools._get_auth()
+
+    default.assert_called_once_with(scopes=("https://www.googleapis.com/auth/cloud-platform",))
+    assert session.credentials is credentials
+
+
+def test_dedupe_expenses_sql_never_partitions_on_float(monkeypatch):
+    client = mock.Mock()
+    monkeypatch.setattr(tools, "_ensure_table", lambda: (client, tools._EXPENSE_TABLE_REF))
+
+    assert tools.dedupe_expenses() == {"status": "success"}
+
+    sql = client.query.call_args.args[0]
+    table = f"{tools.PROJECT_ID}.finance_data.expenses"
+    assert "{table}" not in sql and f"FROM `{table}`" in sql
+    assert "PARTITION BY vendor_name, transaction_date, CAST(total_amount AS NUMERIC)" in sql
+    assert "CAST(dup.total_amount AS NUMERIC) = CAST(expense.total_amount AS NUMERIC)" in sql
+    assert sql.strip().startswith("BEGIN TRANSACTION;") and sql.strip().endswith("COMMIT TRANSACTION;")
+
+
+def test_log_expense_batches_concurrent_calls(monkeypatch):
+    appended = []
+
+    def fake_append(rows):
+        appended.append(len(rows))
+        return []
+
+    monkeypatch.setattr(tools, "_append_serialized_rows", fake_append)
+
+    async def log_many(count):
+        return await asyncio.gather(*(tools.log_expense_to_bigquery(make_receipt()) for _ in range(count)))
+
+    results = asyncio.run(log_many(tools.QUEUE_BATCH_MAX_ROWS + 3))
+
+    assert appended == [tools.QUEUE_BATCH_MAX_ROWS, 3]
+    assert all(result["status"] == "success" for result in results)
+
+
+def test_log_expense_reports_batch_errors_to_every_caller(monkeypatch):
+    monkeypatch.setattr(tools, "_append_serialized_rows", lambda rows: ["row 0: invalid"])
+
+    async def log_two():
+        return await asyncio.gather(*(tools.log_expense_to_bigquery(make_receipt()) for _ in range(2)))
+
+    assert asyncio.run(log_two()) == [{"status": "error", "message": "['row 0: invalid']"}] * 2
+
+
+def test_log_expense_fans_append_exceptions_out(monkeypatch):
+    def failing_append(rows):
+        raise RuntimeError("stream closed")
+
+    monkeypatch.setattr(tools, "_append_serialized_rows", failing_append)
+
+    result = asyncio.run(tools.log_expense_to_bigquery(make_receipt()))
+
+    assert result == {"status": "error", "message": "stream closed"}
+
+
+def test_log_expense_keeps_queues_per_event_loop(monkeypatch):
+    monkeypatch.setattr(tools, "_append_serialized_rows", lambda rows: [])
+    results = []
+
+    async def log_many():
+        return await asyncio.gather(*(tools.log_expense_to_bigquery(make_receipt()) for _ in range(50)))
+
+    threads = [threading.Thread(target=lambda: results.extend(asyncio.run(log_many()))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(results) == 200 and all(result["status"] == "success" for result in results)
+
+
+def test_log_expense_caps_queued_batches_by_bytes(monkeypatch):
+    appended = []
+    row_size = len(tools._encode_row(tools._with_category(make_receipt())))
+    monkeypatch.setattr(tools, "MAX_BATCH_BYTES", row_size * 2)
+    monkeypatch.setattr(tools, "_append_serialized_rows", lambda rows: appended.append(len(rows)) or [])
+
+    async def log_many(count):
+        return await asyncio.gather(*(tools.log_expense_to_bigquery(make_receipt()) for _ in range(count)))
+
+    asyncio.run(log_many(5))
+
+    assert appended == [2, 2, 1]
+
+
+def test_log_expenses_batch_chunks_appends_by_bytes(monkeypatch):
+    appended = []
+    row_size = len(tools._encode_row(tools._with_category(make_receipt())))
+    monkeypatch.setattr(tools, "MAX_BATCH_BYTES", row_size * 3)
+    monkeypatch.setattr(tools, "_append_serialized_rows", lambda rows: appended.append(len(rows)) or [])
+
+    result = tools.log_expenses_batch([make_receipt()] * 7, gcs_staging=None)
+
+    assert result == {"status": "success", "row_count": 7}
+    assert appended == [3, 3, 1]